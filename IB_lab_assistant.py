@@ -1,13 +1,24 @@
 import streamlit as st
 import anthropic
 import base64
-import pandas as pd
+import csv
+import hashlib
+import json
 import os
 import zipfile
 import time
+import logging
+import math
 import re
-from docx import Document
+import random
+import functools
+import threading
+import xml.etree.ElementTree as ET
 from io import BytesIO
+from PIL import Image
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+# pandas and python-docx are imported inside the functions that use them, so a cold
+# server process can show the upload page without loading them (~300 ms)
 
 # --- 1. PAGE SETUP (MUST BE FIRST) ---
 st.set_page_config(
@@ -17,6 +28,10 @@ st.set_page_config(
 )
 
 # --- 2. CONFIGURATION & SECRETS ---
+# One logger for the app; records from grading threads don't interleave like print() did
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+log = logging.getLogger("ib_lab")
+
 if "ANTHROPIC_API_KEY" in st.secrets:
     API_KEY = st.secrets["ANTHROPIC_API_KEY"]
 elif "ANTHROPIC_API_KEY" in os.environ:
@@ -210,6 +225,7 @@ SYSTEM_PROMPT = """You are a STRICT IB Chemistry Examiner.
 **CRITICAL INSTRUCTION:** 1. Perform ALL math calculations for ALL sections inside a single `<math_scratchpad>` block at the VERY START of your response. 
 2. The user will NOT see this block (it is filtered out).
 3. Do NOT include any math or deduction logic in the "OUTPUT FORMAT" sections. Only the final feedback text.
+4. Keep the scratchpad compact: one line per section, e.g. `7: 10-1.0-0.5=8.5`. No prose.
 
 1.  **INTRODUCTION (Section 2) - DEDUCTION PROTOCOL:**
     * **Start at 10.0 Points.**
@@ -267,6 +283,7 @@ SYSTEM_PROMPT = """You are a STRICT IB Chemistry Examiner.
 
 ### OUTPUT FORMAT:
 Please strictly use the following format. Do not use horizontal rules (---) between sections. Do NOT print the calculation steps here.
+If a section has no Strengths or no Improvements to report, write "None" instead of a sentence.
 
 # 📝 SCORE: [Total Points]/100
 STUDENT: [Filename]
@@ -329,6 +346,78 @@ STUDENT: [Filename]
 3. [Step 3 - Specific and concrete recommendation]
 """
 
+# Static prefix sent with every grading request. Both blocks are cache breakpoints,
+# so only the first report in a session pays full input-token price for them.
+SYSTEM_BLOCKS = [
+    {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}},
+    {"type": "text", "text": "--- RUBRIC START ---\n" + IB_RUBRIC + "\n--- RUBRIC END ---", "cache_control": {"type": "ephemeral"}}
+]
+
+# Grades keyed by content hash + settings, appended one JSON line per grade to the
+# autosave folder so re-uploads are free across reruns and restarts.
+# Delete the file to force fresh grades.
+GRADE_CACHE_FILE = "grade_cache.jsonl"
+
+def load_grade_cache(autosave_dir):
+    cache = {}
+    try:
+        with open(os.path.join(autosave_dir, GRADE_CACHE_FILE), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    cache[entry['key']] = entry['feedback']
+                except (ValueError, KeyError): # a line cut short by a crash
+                    continue
+    except FileNotFoundError:
+        pass
+    return cache
+
+def persist_grade_cache(autosave_dir, key, feedback):
+    try:
+        os.makedirs(autosave_dir, exist_ok=True)
+        with open(os.path.join(autosave_dir, GRADE_CACHE_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"key": key, "feedback": feedback}, ensure_ascii=False) + "\n")
+    except OSError:
+        log.exception("Could not persist grade cache entry")
+
+# Submitted batches that haven't been collected yet, one JSON line per change (a null
+# "info" marks one as collected). Kept on disk because a batch can take hours and
+# outlives the browser session that submitted it.
+PENDING_BATCHES_FILE = "pending_batches.jsonl"
+
+def load_pending_batches(autosave_dir):
+    pending = {}
+    try:
+        with open(os.path.join(autosave_dir, PENDING_BATCHES_FILE), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    if entry['info'] is None:
+                        pending.pop(entry['batch_id'], None)
+                    else:
+                        pending[entry['batch_id']] = entry['info']
+                except (ValueError, KeyError): # a line cut short by a crash
+                    continue
+    except FileNotFoundError:
+        pass
+    return pending
+
+def persist_pending_batch(autosave_dir, batch_id, info):
+    try:
+        os.makedirs(autosave_dir, exist_ok=True)
+        with open(os.path.join(autosave_dir, PENDING_BATCHES_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"batch_id": batch_id, "info": info}, ensure_ascii=False) + "\n")
+    except OSError:
+        log.exception("Could not persist pending batch %s", batch_id)
+
+def add_pending_batch(batch_id, info):
+    st.session_state.pending_batches[batch_id] = info
+    persist_pending_batch(st.session_state.autosave_dir, batch_id, info)
+
+def remove_pending_batch(batch_id):
+    st.session_state.pending_batches.pop(batch_id, None)
+    persist_pending_batch(st.session_state.autosave_dir, batch_id, None)
+
 # Initialize Session State
 if 'saved_sessions' not in st.session_state:
     st.session_state.saved_sessions = {}
@@ -338,87 +427,324 @@ if 'current_session_name' not in st.session_state:
     st.session_state.current_session_name = "New Grading Session"
 if 'autosave_dir' not in st.session_state:
     st.session_state.autosave_dir = "autosave_feedback_ib"
+if 'pending_batches' not in st.session_state:
+    # batch_id -> {"session": session name, "files": {custom_id: filename}, "cache_keys": {filename: key}}
+    st.session_state.pending_batches = load_pending_batches(st.session_state.autosave_dir)
+if 'grade_cache' not in st.session_state:
+    # "content hash|grading settings" -> feedback, so re-uploads skip the API
+    st.session_state.grade_cache = load_grade_cache(st.session_state.autosave_dir)
+
+# The SDK default waits up to 10 minutes on a silent connection. Streamed feedback
+# arrives continuously, so 90s without a byte means the request is stuck; the
+# resulting APITimeoutError is an APIConnectionError and gets retried.
+API_TIMEOUT = anthropic.Timeout(connect=5.0, read=90.0, write=30.0, pool=10.0)
+
+@st.cache_resource
+def get_client():
+    """
+    One client for the whole server process. Streamlit reruns this script on every
+    interaction; caching keeps the HTTPS connection pool (and its TLS sessions) alive.
+    Batch calls keep the SDK's own retries; the grading stream turns them off (see request_feedback).
+    """
+    return anthropic.Anthropic(api_key=API_KEY, timeout=API_TIMEOUT)
+
+client = get_client()
 
-client = anthropic.Anthropic(api_key=API_KEY)
+# Upper bound on in-flight API calls across every browser session on this server
+# (they all share one client and one API key). Each session's own concurrency is
+# the "Parallel Requests" slider; this only stops several sessions stacking up.
+MAX_CONCURRENT_REQUESTS = 10
+
+@st.cache_resource
+def get_api_gate():
+    return threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+api_gate = get_api_gate()
 
 # --- 5. HELPER FUNCTIONS ---
+# Patterns used on every graded report, compiled once at startup
+_SCRATCHPAD_RE = re.compile(r'<math_scratchpad>.*?</math_scratchpad>', re.DOTALL)
+_MATH_RE = re.compile(r'<<<MATH:.*?>>>', re.DOTALL)
+_SCORE_LINE_RE = re.compile(r"\d+\..+?:[^0-9\n]*?(\d+\.?\d*)[^0-9\n]*?/\s*10")
+_TOTAL_RE = re.compile(r"(#\s*[🔍📝]?\s*SCORE\s*:\s*)([\d\.]+)(\s*/\s*100)", re.IGNORECASE)
+_SCORE_RE = re.compile(r"(?:#\s*[🔍📝]?\s*)?SCORE:\s*([\d\.]+)/100", re.IGNORECASE)
+_SUMMARY_RE = re.compile(r"OVERALL SUMMARY.*?:\s*\n(.*?)(?=1\.|DETAILED)", re.DOTALL | re.IGNORECASE)
+# Section headers are matched line-by-line and bodies sliced between them, which keeps
+# parse_feedback_for_csv linear (no lazy .*? re-scanning the rest of the text per section)
+_SECTION_HEADER_RE = re.compile(r"^[ \t]*(\d+)\.[ \t]+([A-Za-z &]{1,40}):[ \t]+([\d.]+)/10[ \t\r]*$", re.MULTILINE)
+_SECTION_END_RE = re.compile(r"\n\d+\.|💡")
+_MD_STRIP = str.maketrans('', '', '*#')
+
 def encode_file(uploaded_file):
+    # Encoded once per report by build_user_message; retries and the fast-mode
+    # re-grade reuse that payload. getvalue() leaves the shared file position alone.
     try:
-        uploaded_file.seek(0)
-        return base64.b64encode(uploaded_file.read()).decode('utf-8')
-    except Exception as e:
-        st.error(f"Error encoding file: {e}")
+        return base64.b64encode(uploaded_file.getvalue()).decode('ascii')
+    except Exception:
+        # Runs inside grading worker threads, which cannot draw Streamlit elements
+        log.exception("Error encoding file %s", getattr(uploaded_file, 'name', '?'))
         return None
 
+MEDIA_TYPES = {
+    'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg',
+    'gif': 'image/gif', 'webp': 'image/webp', 'pdf': 'application/pdf'
+}
+
 def get_media_type(filename):
-    ext = filename.lower().split('.')[-1]
-    media_types = {
-        'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg',
-        'gif': 'image/gif', 'webp': 'image/webp', 'pdf': 'application/pdf'
-    }
-    return media_types.get(ext, 'image/jpeg')
-
-def get_para_text_with_formatting(para):
-    """Iterate through runs to capture subscript/superscript formatting."""
-    text_parts = []
-    for run in para.runs:
-        text = run.text
-        if run.font.subscript:
-            text = f"<sub>{text}</sub>"
-        elif run.font.superscript:
-            text = f"<sup>{text}</sup>"
-        text_parts.append(text)
-    return "".join(text_parts)
-
-def extract_text_from_docx(file):
+    return MEDIA_TYPES.get(filename.rsplit('.', 1)[-1].lower(), 'image/jpeg')
+
+# WordprocessingML tags, read straight from word/document.xml (no python-docx object tree)
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+W_BODY, W_P, W_R, W_T, W_BR = _W + "body", _W + "p", _W + "r", _W + "t", _W + "br"
+W_TBL, W_TR, W_TC = _W + "tbl", _W + "tr", _W + "tc"
+W_SECTPR = _W + "sectPr"
+W_VAL = _W + "val"
+# Other run children that read as text (same mapping python-docx uses for run.text)
+_RUN_CHARS = {_W + "tab": "\t", _W + "ptab": "\t", _W + "cr": "\n", _W + "noBreakHyphen": "-"}
+
+def append_para_text(p, parts):
+    """Append a <w:p>'s runs to parts, marking subscript/superscript formatting."""
+    for r in p.iterfind(W_R):
+        chunks = []
+        for child in r:
+            tag = child.tag
+            if tag == W_T:
+                chunks.append(child.text or "")
+            elif tag == W_BR:
+                # Page and column breaks have no text; plain line breaks do
+                if child.get(_W + "type", "textWrapping") == "textWrapping":
+                    chunks.append("\n")
+            elif tag in _RUN_CHARS:
+                chunks.append(_RUN_CHARS[tag])
+        text = "".join(chunks)
+        align = r.find(f"{_W}rPr/{_W}vertAlign")
+        align = align.get(W_VAL) if align is not None else None
+        if align == "subscript":
+            parts.append(f"<sub>{text}</sub>")
+        elif align == "superscript":
+            parts.append(f"<sup>{text}</sup>")
+        else:
+            parts.append(text)
+
+def strip_fragments(parts, start):
+    """Same as str.strip() on "".join(parts[start:]), but done in place on the fragments."""
+    while len(parts) > start and not parts[-1].strip():
+        parts.pop()
+    if len(parts) > start:
+        parts[-1] = parts[-1].rstrip()
+    while len(parts) > start and not parts[start].strip():
+        del parts[start]
+    if len(parts) > start:
+        parts[start] = parts[start].lstrip()
+
+def cell_property(tc, name):
+    """w:val of ./w:tcPr/w:<name>; "" if the element has no w:val, None if it is absent."""
+    prop = tc.find(f"{_W}tcPr/{_W}{name}")
+    return None if prop is None else prop.get(W_VAL, "")
+
+def append_table_text(tbl, parts):
+    """Append a <w:tbl> row by row as "a | b | c" lines (merged cells repeat, like python-docx)."""
+    above = {} # grid offset -> the w:tc holding the content there, for vertical merges
+    for tr in tbl.iterfind(W_TR):
+        before = tr.find(f"{_W}trPr/{_W}gridBefore")
+        offset = int(before.get(W_VAL, 0)) if before is not None else 0
+        row = {}
+        col = 0
+        for tc in tr.iterfind(W_TC):
+            span = int(cell_property(tc, "gridSpan") or 1)
+            # vMerge with no val (or "continue") means "same cell as the row above"
+            if cell_property(tc, "vMerge") in ("", "continue"):
+                tc = above.get(offset, tc)
+            row[offset] = tc
+            for _ in range(int(cell_property(tc, "gridSpan") or 1)):
+                if col:
+                    parts.append(" | ")
+                col += 1
+                cell_start = len(parts)
+                for p_idx, p in enumerate(tc.iterfind(W_P)):
+                    if p_idx:
+                        parts.append(" ")
+                    append_para_text(p, parts)
+                strip_fragments(parts, cell_start)
+            offset += span
+        above = row
+        parts.append("\n")
+
+def docx_body_text(document_xml):
+    """
+    Body paragraphs followed by a DETECTED TABLES section, same layout as before.
+    document_xml is a file object; it is parsed incrementally and each top-level
+    paragraph/table is dropped once read, so the full tree never sits in memory.
+    """
+    # Everything goes into lists of fragments (each item followed by a "\n"),
+    # joined once at the end instead of per cell/row/paragraph
+    parts = []
+    table_parts = []
+    body = None
+    depth = 0
+    for event, elem in ET.iterparse(document_xml, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2 and elem.tag == W_BODY:
+                body = elem
+            continue
+        depth -= 1
+        if depth != 2 or body is None: # only direct children of <w:body>
+            continue
+        if elem.tag == W_P:
+            append_para_text(elem, parts)
+            parts.append("\n")
+        elif elem.tag == W_TBL:
+            append_table_text(elem, table_parts)
+            table_parts.append("\n")
+            table_parts.append("\n")
+        body.remove(elem)
+    if table_parts:
+        parts.append("\n--- DETECTED TABLES ---\n")
+        parts.append("\n")
+        parts.extend(table_parts)
+    if parts:
+        parts.pop() # no separator after the last item
+    return "".join(parts)
+
+# Claude scales larger images down to this edge anyway, so shrink before uploading
+MAX_IMAGE_EDGE = 1568
+# Anything smaller is an icon, bullet, logo or equation snippet rather than a graph or photo
+MIN_IMAGE_EDGE = 100
+MIN_IMAGE_AREA = 200 * 200
+# Grey-level spread below this is a blank box, colour block or divider line
+MIN_IMAGE_CONTRAST = 20
+JPEG_QUALITY = 80
+# Media entries under this many bytes are icons/bullets; skipped from the zip directory alone
+MIN_IMAGE_BYTES = 4 * 1024
+# Small JPEGs that already fit are sent as-is; re-encoding them costs CPU and saves nothing
+PASSTHROUGH_IMAGE_BYTES = 256 * 1024
+
+def shrink_image(stream, passthrough=False):
+    """
+    Re-encode an embedded image as a JPEG no larger than MAX_IMAGE_EDGE. Returns None for icons and blanks.
+    With passthrough, a JPEG that needs no resizing is returned with its original bytes.
+    """
+    with Image.open(stream) as img:
+        # Only the header has been read so far, so tiny images are skipped without decoding
+        if img.width < MIN_IMAGE_EDGE or img.height < MIN_IMAGE_EDGE or img.width * img.height < MIN_IMAGE_AREA:
+            return None
+        keep_original = passthrough and img.format == 'JPEG' and img.mode in ('RGB', 'L') \
+            and max(img.size) <= MAX_IMAGE_EDGE
+        # JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale (no-op for other formats),
+        # so a 4000px phone photo never gets fully decoded just to be thrown away
+        img.draft('RGB', (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # Flatten transparency onto white so transparent graphs stay readable
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, 'white')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        darkest, lightest = img.convert('L').getextrema()
+        if lightest - darkest < MIN_IMAGE_CONTRAST:
+            return None
+        if keep_original:
+            stream.seek(0)
+            return stream.read()
+        out = BytesIO()
+        img.save(out, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+def docx_image_block(z, info):
+    """Image block for one word/media/* entry, or None if it is skipped."""
     try:
-        file.seek(0) 
-        doc = Document(file)
-        full_text = []
-        for para in doc.paragraphs:
-            full_text.append(get_para_text_with_formatting(para))
-        if doc.tables:
-            full_text.append("\n--- DETECTED TABLES ---\n")
-            for table in doc.tables:
-                for row in table.rows:
-                    row_text = []
-                    for cell in row.cells:
-                        cell_content = []
-                        for para in cell.paragraphs:
-                            cell_content.append(get_para_text_with_formatting(para))
-                        row_text.append(" ".join(cell_content).strip())
-                    full_text.append(" | ".join(row_text))
-                full_text.append("\n") 
-        return "\n".join(full_text)
+        # Decode straight from the zip stream; only the shrunk copy is base64-encoded
+        with z.open(info) as stream:
+            img_data = shrink_image(stream, passthrough=info.file_size <= PASSTHROUGH_IMAGE_BYTES)
     except Exception as e:
-        return f"Error reading .docx file: {e}"
+        log.warning("Skipping image %s: %s", info.filename, e)
+        return None
+    if img_data is None:
+        return None
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64", 
+            "media_type": "image/jpeg", 
+            "data": base64.b64encode(img_data).decode('ascii')
+        }
+    }
 
-def extract_images_from_docx(file):
+@st.cache_data(show_spinner=False, max_entries=200)
+def extract_docx_content(file_bytes):
+    """
+    Text and images of one .docx from a single pass over its zip: word/document.xml is
+    parsed directly and word/media/* is shrunk in the same loop. Cached by content so
+    re-grading the same file skips the parse.
+    """
+    text = ""
     images = []
+    seen_media = set()
     try:
-        file.seek(0)
-        with zipfile.ZipFile(file) as z:
-            for filename in z.namelist():
-                if filename.startswith('word/media/') and filename.split('.')[-1].lower() in ['png', 'jpg', 'jpeg', 'gif']:
-                    img_data = z.read(filename)
-                    b64_img = base64.b64encode(img_data).decode('utf-8')
-                    ext = filename.split('.')[-1].lower()
-                    images.append({
-                        "type": "image",
-                        "source": {
-                            "type": "base64", 
-                            "media_type": f"image/{'jpeg' if ext=='jpg' else ext}", 
-                            "data": b64_img
-                        }
-                    })
+        with zipfile.ZipFile(BytesIO(file_bytes)) as z:
+            for info in z.infolist():
+                filename = info.filename
+                if filename == 'word/document.xml':
+                    with z.open(info) as document_xml:
+                        text = docx_body_text(document_xml)
+                elif filename.startswith('word/media/') and filename.split('.')[-1].lower() in ['png', 'jpg', 'jpeg', 'gif']:
+                    if info.file_size < MIN_IMAGE_BYTES:
+                        continue
+                    # Repeated headers/logos are separate media entries with identical bytes;
+                    # CRC + size from the zip directory spots them without reading anything
+                    key = (info.CRC, info.file_size)
+                    if key in seen_media:
+                        continue
+                    seen_media.add(key)
+                    block = docx_image_block(z, info)
+                    if block:
+                        images.append(block)
     except Exception as e:
-        print(f"Image extraction failed: {e}")
-    return images
+        return f"Error reading .docx file: {e}", []
+    return text, images
+
+IGNORED_FILES = {'.ds_store', 'desktop.ini', 'thumbs.db', '__macosx'}
+VALID_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'webp', 'docx'}
+
+# Per-member limits for uploaded ZIPs. No single report gets near 25 MB, and a real
+# PDF/DOCX/image barely compresses, so a 100:1 ratio means a zip bomb.
+MAX_MEMBER_BYTES = 25 * 1024 * 1024
+MAX_COMPRESSION_RATIO = 100
+
+# Every entry holds a whole class set, fully inflated, so keep only the last few
+# uploads; the 1 GB Community Cloud limit is easy to hit with image-heavy PDFs
+@st.cache_data(show_spinner=False, max_entries=3)
+def extract_zip_members(zip_bytes):
+    """
+    (name, bytes) for every gradable file in an uploaded ZIP, cached so reruns don't re-inflate it.
+    Returns (members, skipped) where skipped lists the names of oversized entries.
+    """
+    members = []
+    skipped = []
+    with zipfile.ZipFile(BytesIO(zip_bytes)) as z:
+        for info in z.infolist():
+            filename = info.filename
+            clean_name = filename.lower()
+            if any(x in clean_name for x in IGNORED_FILES) or filename.startswith('.'): continue
+            if clean_name.split('.')[-1] not in VALID_EXTENSIONS: continue
+            # Checked against the zip directory before anything is inflated
+            if info.file_size > MAX_MEMBER_BYTES or info.file_size > MAX_COMPRESSION_RATIO * max(info.compress_size, 1):
+                skipped.append(filename)
+                continue
+            # The directory can lie, so never inflate more than the cap either way
+            with z.open(info) as src:
+                file_bytes = src.read(MAX_MEMBER_BYTES + 1)
+            if len(file_bytes) > MAX_MEMBER_BYTES:
+                skipped.append(filename)
+                continue
+            members.append((os.path.basename(filename), file_bytes))
+    return members, skipped
 
 def process_uploaded_files(uploaded_files):
     final_files = []
-    IGNORED_FILES = {'.ds_store', 'desktop.ini', 'thumbs.db', '__macosx'}
-    VALID_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'webp', 'docx'}
     file_counts = {"pdf": 0, "docx": 0, "image": 0, "ignored": 0}
 
     for file in uploaded_files:
@@ -427,19 +753,17 @@ def process_uploaded_files(uploaded_files):
             continue
         if file_name_lower.endswith('.zip'):
             try:
-                with zipfile.ZipFile(file) as z:
-                    for filename in z.namelist():
-                        clean_name = filename.lower()
-                        if any(x in clean_name for x in IGNORED_FILES) or filename.startswith('.'): continue
-                        ext = clean_name.split('.')[-1]
-                        if ext in VALID_EXTENSIONS:
-                            file_bytes = z.read(filename)
-                            virtual_file = BytesIO(file_bytes)
-                            virtual_file.name = os.path.basename(filename)
-                            final_files.append(virtual_file)
-                            if ext == 'docx': file_counts['docx'] += 1
-                            elif ext == 'pdf': file_counts['pdf'] += 1
-                            else: file_counts['image'] += 1
+                members, skipped = extract_zip_members(file.getvalue())
+                for member_name in skipped:
+                    st.warning(f"⚠️ Skipping {member_name} in {file.name} (too large or suspiciously compressed)")
+                for member_name, file_bytes in members:
+                    virtual_file = BytesIO(file_bytes)
+                    virtual_file.name = member_name
+                    final_files.append(virtual_file)
+                    ext = member_name.lower().split('.')[-1]
+                    if ext == 'docx': file_counts['docx'] += 1
+                    elif ext == 'pdf': file_counts['pdf'] += 1
+                    else: file_counts['image'] += 1
             except Exception as e:
                 st.error(f"Error unzipping {file.name}: {e}")
         else:
@@ -456,37 +780,38 @@ def process_uploaded_files(uploaded_files):
 def clean_hidden_math(text):
     """Removes the <math_scratchpad> and <<<MATH: ... >>> blocks from the AI output."""
     # Remove XML style scratchpad
-    text = re.sub(r'<math_scratchpad>.*?</math_scratchpad>', '', text, flags=re.DOTALL)
+    text = _SCRATCHPAD_RE.sub('', text)
     # Remove old style blocks just in case
-    text = re.sub(r'<<<MATH:.*?>>>', '', text, flags=re.DOTALL)
+    text = _MATH_RE.sub('', text)
     return text.strip()
 
+def preview_feedback(text):
+    """Partly streamed feedback as it should be shown live: hidden math removed, including a block that hasn't closed yet."""
+    text = clean_hidden_math(text)
+    for opener in ('<math_scratchpad>', '<<<MATH:'):
+        cut = text.find(opener)
+        if cut != -1:
+            text = text[:cut]
+    return text
+
 def recalculate_total_score(text):
     """
     Robustly parses section scores even if the AI uses inconsistent bolding/markdown,
     sums them up, and overwrites the header score.
     """
     try:
-        # 1. ROBUST PATTERN: 
+        # 1. ROBUST PATTERN (_SCORE_LINE_RE): 
         # Matches: "1. SECTION NAME: [**]9.5[**]/10"
-        pattern = r"\d+\..+?:[^0-9\n]*?(\d+\.?\d*)[^0-9\n]*?/\s*10"
+        # fsum keeps decimal scores exact: a plain running sum turns e.g. 1.3 + 2.7 + ...
+        # into 34.99999999999999, which the header would then show as "35.0"
+        scores = [float(match.group(1)) for match in _SCORE_LINE_RE.finditer(text)]
+        section_count = len(scores)
         
-        matches = re.findall(pattern, text)
-        
-        if matches:
-            # Convert extracted strings to floats
-            scores = []
-            for s in matches:
-                try:
-                    scores.append(float(s))
-                except ValueError:
-                    continue
-            
+        if section_count:
+            total_score = math.fsum(scores)
             # 2. SANITY CHECK: expected 10 sections
-            if len(scores) != 10:
-                print(f"DEBUG: Warning - Found {len(scores)} section scores (expected 10).")
-            
-            total_score = sum(scores)
+            if section_count != 10:
+                log.warning("Found %d section scores (expected 10).", section_count)
             
             # Format: Integer if whole number, else 1 decimal place
             if total_score.is_integer():
@@ -494,51 +819,55 @@ def recalculate_total_score(text):
             else:
                 total_score_str = f"{total_score:.1f}"
             
-            print(f"DEBUG: Recalculated Total: {total_score_str} (from {scores})")
+            log.debug("Recalculated total: %s (from %d sections)", total_score_str, section_count)
             
             # 3. ROBUST HEADER REPLACEMENT
-            # Look for "SCORE:" followed by any junk, then the old score, then "/100"
-            header_pattern = r"(#\s*[🔍📝]?\s*SCORE\s*:\s*)([\d\.]+)(\s*/\s*100)"
-            
-            if re.search(header_pattern, text, re.IGNORECASE):
-                text = re.sub(
-                    header_pattern, 
-                    f"\\g<1>{total_score_str}\\g<3>", 
-                    text, 
-                    count=1,
-                    flags=re.IGNORECASE
-                )
-            else:
+            # Look for "SCORE:" followed by any junk, then the old score, then "/100" (_TOTAL_RE).
+            # subn finds and replaces in one pass and tells us whether a header existed.
+            text, replaced = _TOTAL_RE.subn(f"\\g<1>{total_score_str}\\g<3>", text, count=1)
+            if not replaced:
                 # If header is missing or formatted oddly, force prepend it
                 text = f"# 📝 SCORE: {total_score_str}/100\n\n" + text
                 
         else:
-            print("DEBUG: No section scores found to recalculate.")
+            log.warning("No section scores found to recalculate.")
             
-    except Exception as e:
-        print(f"ERROR in recalculate_total_score: {e}")
+    except Exception:
+        log.exception("recalculate_total_score failed")
     
     return text
 
+def flatten_lines(text):
+    """Joins the non-blank lines of a block with single spaces (one CSV cell, no newlines)."""
+    return " ".join(line.strip() for line in text.splitlines() if line.strip())
+
+# Cached by feedback text: the results page rebuilds the gradebook on every rerun,
+# and autosave parses the same report right after grading
+@st.cache_data(show_spinner=False, max_entries=1000)
 def parse_feedback_for_csv(text):
     data = {}
-    clean_text = re.sub(r'[*#]', '', text) 
+    clean_text = text.translate(_MD_STRIP)
     try:
-        summary_match = re.search(r"OVERALL SUMMARY.*?:\s*\n(.*?)(?=1\.|DETAILED)", clean_text, re.DOTALL | re.IGNORECASE)
+        summary_match = _SUMMARY_RE.search(clean_text)
         if summary_match:
-            raw_summary = summary_match.group(1).strip()
-            data["Overall Summary"] = re.sub(r'[\r\n]+', ' ', raw_summary)
+            data["Overall Summary"] = flatten_lines(summary_match.group(1))
         else:
             data["Overall Summary"] = "Summary not found"
     except Exception as e:
         data["Overall Summary"] = f"Parsing Error: {e}"
 
-    sections = re.findall(r"(\d+)\.\s+([A-Za-z\s&]+):\s+([\d\.]+)/10\s*\n(.*?)(?=\n\d+\.|\Z|💡)", clean_text, re.DOTALL)
-    for _, name, score, content in sections:
-        col_name = name.strip().title()
-        data[f"{col_name} Score"] = score
-        cleaned_feedback = re.sub(r'[\r\n]+', ' ', content.strip())
-        data[f"{col_name} Feedback"] = cleaned_feedback
+    headers = list(_SECTION_HEADER_RE.finditer(clean_text))
+    for idx, header in enumerate(headers):
+        body_start = header.end()
+        body_end = headers[idx + 1].start() if idx + 1 < len(headers) else len(clean_text)
+        # A section also ends at the next numbered line or the "💡 TOP 3" block
+        stop = _SECTION_END_RE.search(clean_text, body_start, body_end)
+        if stop:
+            body_end = stop.start()
+        content = clean_text[body_start:body_end]
+        col_name = header.group(2).strip().title()
+        data[f"{col_name} Score"] = header.group(3)
+        data[f"{col_name} Feedback"] = flatten_lines(content)
     return data
 
 def audit_score_with_ai(client, feedback_text):
@@ -570,155 +899,304 @@ def audit_score_with_ai(client, feedback_text):
             return int(true_total)
         else:
             return None
-    except Exception as e:
-        print(f"Math Audit Error: {e}")
+    except Exception:
+        log.exception("Math audit failed")
         return None
 
-# --- NEW FUNCTION: AUTOSAVE INDIVIDUAL REPORT ---
-def autosave_report(item, autosave_dir):
-    """Save individual report as Word doc and append to CSV immediately after grading."""
-    try:
-        # --- FIX: FORCE FOLDER CREATION ---
-        if not os.path.exists(autosave_dir):
-            os.makedirs(autosave_dir)
-        # ----------------------------------
-        # 1. Save Word Document
-        doc = Document()
-        write_markdown_to_docx(doc, item['Feedback'])
-        safe_filename = os.path.splitext(item['Filename'])[0] + "_Feedback.docx"
-        doc_path = os.path.join(autosave_dir, safe_filename)
-        doc.save(doc_path)
-        
-        # 2. Append to CSV (or create if doesn't exist)
-        csv_path = os.path.join(autosave_dir, "gradebook.csv")
-        
-        # Parse feedback into row data
-        row_data = {
-            "Filename": item['Filename'],
-            "Overall Score": item['Score']
-        }
-        feedback_data = parse_feedback_for_csv(item['Feedback'])
-        row_data.update(feedback_data)
-        
-        # Check if CSV exists
-        if os.path.exists(csv_path):
-            existing_df = pd.read_csv(csv_path)
-            # Remove duplicate if re-grading same file
-            existing_df = existing_df[existing_df['Filename'] != item['Filename']]
-            new_df = pd.concat([existing_df, pd.DataFrame([row_data])], ignore_index=True)
-        else:
-            new_df = pd.DataFrame([row_data])
-        
-        new_df.to_csv(csv_path, index=False, encoding='utf-8-sig')
-        
-        return True
-    except Exception as e:
-        print(f"Autosave failed for {item['Filename']}: {e}")
-        return False
+# Batches are 50% cheaper and run server-side in parallel, but can take minutes,
+# so small uploads still go through the live per-file path.
+BATCH_MIN_FILES = 10
+BATCH_POLL_INTERVAL = 10
+# Without Batch Mode the page waits for the batch, but not for its whole 24h window:
+# after this long the rest of the class set is graded live instead
+BATCH_MAX_WAIT = 20 * 60
+# Threads for building request payloads up front. The heavy parts (zip inflate,
+# Pillow decode/resize/encode) release the GIL. A process pool is not an option:
+# functions defined in a Streamlit script can't be pickled to worker processes.
+PREP_WORKERS = min(8, os.cpu_count() or 1)
+
+# Updated Prompt Construction for Educational Depth
+USER_INSTRUCTIONS = (
+    "Please grade this lab report based on the provided rubric.\n"
+    "🚨 **INSTRUCTION FOR FEEDBACK DEPTH:**\n"
+    "1. **BE SPECIFIC:** Do not be vague. If you deduct points, you must explain exactly **WHY**.\n"
+    "2. **BE EDUCATIONAL:** Explain the scientific reason behind the rules.\n"
+    "3. **PHRASING:** When citing rules, simply say **'The rubric requires...'**. Do NOT cite specific section numbers (e.g. do NOT say 'Section 4 requires...').\n"
+    "\n⚠️ **CRITICAL RUBRIC UPDATES TO ENFORCE:**\n"
+    "4. **FORMATTING:** \n"
+    "   - **Redundancy:** Do NOT deduct for terms like 'HCl acid' or 'Na salt'. Ignore this redundancy completely.\n"
+    "1. **MATERIALS:** Look for uncertainty values (±). If missing in Materials but present in Data -> -0.5 only.\n"
+    "2. **DATA ANALYSIS:** \n"
+    "   - **Attempt Rule:** If they attempted ANY uncertainty math (even if wrong) -> Deduct 1.0. Only deduct 2.0 if completely missing.\n"
+    "   - **Derived Independent Variables:** If they list 'Temp' and '1/Temp' as two IVs, this is CORRECT. Do not deduct.\n"
+    "   - **Chromatography Exception:** If the lab is Paper Chromatography, accept Bar Charts. Do NOT deduct for missing Trendlines, Equations, or R² values.\n"
+    "3. **VARIABLES:** \n"
+    "   - **Categorization Error:** If they list specific instances (e.g. Zinc, Mg) instead of a category (Type of Metal) -> Deduct 1.0 (Categorization), NOT 4.0 (Missing Controls).\n"
+    "   - **Derived Independent Variables:** Do NOT deduct points if the student lists multiple Independent Variables where the extra ones are mathematically derived from the main IV.\n"
+    "4. **REFERENCES:** \n"
+    "   - Only deduct **0.5 points** for minor APA formatting errors.\n"
+    "5. **INTRODUCTION (No Reaction):** \n"
+    "   - If the lab is purely physical (e.g. Chromatography, Density), do NOT deduct for a missing chemical equation.\n"
+)
 
-def grade_submission(file, model_id):
+# Same for every report, so it is the third cache breakpoint (after the system prompt
+# and rubric); only the student's own text/images are uncached input
+INSTRUCTIONS_BLOCK = {"type": "text", "text": USER_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}
+
+def build_user_message(file):
+    """Build the user content blocks (cached instructions + student work) for one report."""
     ext = file.name.split('.')[-1].lower()
-    
-    # Updated Prompt Construction for Educational Depth
-    user_instructions = (
-        "Please grade this lab report based on the provided rubric.\n"
-        "🚨 **INSTRUCTION FOR FEEDBACK DEPTH:**\n"
-        "1. **BE SPECIFIC:** Do not be vague. If you deduct points, you must explain exactly **WHY**.\n"
-        "2. **BE EDUCATIONAL:** Explain the scientific reason behind the rules.\n"
-        "3. **PHRASING:** When citing rules, simply say **'The rubric requires...'**. Do NOT cite specific section numbers (e.g. do NOT say 'Section 4 requires...').\n"
-        "\n⚠️ **CRITICAL RUBRIC UPDATES TO ENFORCE:**\n"
-        "4. **FORMATTING:** \n"
-        "   - **Redundancy:** Do NOT deduct for terms like 'HCl acid' or 'Na salt'. Ignore this redundancy completely.\n"
-        "1. **MATERIALS:** Look for uncertainty values (±). If missing in Materials but present in Data -> -0.5 only.\n"
-        "2. **DATA ANALYSIS:** \n"
-        "   - **Attempt Rule:** If they attempted ANY uncertainty math (even if wrong) -> Deduct 1.0. Only deduct 2.0 if completely missing.\n"
-        "   - **Derived Independent Variables:** If they list 'Temp' and '1/Temp' as two IVs, this is CORRECT. Do not deduct.\n"
-        "   - **Chromatography Exception:** If the lab is Paper Chromatography, accept Bar Charts. Do NOT deduct for missing Trendlines, Equations, or R² values.\n"
-        "3. **VARIABLES:** \n"
-        "   - **Categorization Error:** If they list specific instances (e.g. Zinc, Mg) instead of a category (Type of Metal) -> Deduct 1.0 (Categorization), NOT 4.0 (Missing Controls).\n"
-        "   - **Derived Independent Variables:** Do NOT deduct points if the student lists multiple Independent Variables where the extra ones are mathematically derived from the main IV.\n"
-        "4. **REFERENCES:** \n"
-        "   - Only deduct **0.5 points** for minor APA formatting errors.\n"
-        "5. **INTRODUCTION (No Reaction):** \n"
-        "   - If the lab is purely physical (e.g. Chromatography, Density), do NOT deduct for a missing chemical equation.\n"
-    )
 
     if ext == 'docx':
-        text_content = extract_text_from_docx(file)
+        # Document blocks only take PDF or plain text (a .docx source is rejected with a 400),
+        # so Word files are still unpacked here; extract_docx_content caches the result
+        text_content, images = extract_docx_content(file.getvalue())
         if len(text_content.strip()) < 50:
             text_content += "\n\n[SYSTEM NOTE: Very little text extracted.]"
             
-        prompt_text = (
-            f"{user_instructions}\n"
-            "--- RUBRIC START ---\n" + IB_RUBRIC + "\n--- RUBRIC END ---\n\n"
-            "STUDENT TEXT:\n" + text_content
-        )
-        
-        user_message = [{"type": "text", "text": prompt_text}]
-        images = extract_images_from_docx(file)
+        user_message = [INSTRUCTIONS_BLOCK, {"type": "text", "text": "STUDENT TEXT:\n" + text_content}]
         if images:
             user_message.extend(images)
     else:
         base64_data = encode_file(file)
-        if not base64_data: return "Error processing file."
+        if not base64_data: return None
         media_type = get_media_type(file.name)
         
-        prompt_text = (
-            f"{user_instructions}\n"
-            "--- RUBRIC START ---\n" + IB_RUBRIC + "\n--- RUBRIC END ---\n"
-        )
-        
         user_message = [
-            {"type": "text", "text": prompt_text},
+            INSTRUCTIONS_BLOCK,
             {"type": "document" if media_type == 'application/pdf' else "image",
              "source": {"type": "base64", "media_type": media_type, "data": base64_data}}
         ]
+    return user_message
+
+# A complete 10-section report is ~1500-2000 tokens with the compact scratchpad
+MAX_OUTPUT_TOKENS = 2200
+
+# Concise mode: short bullets, and generation stops where the "Top 3 steps" block would start.
+# The addendum comes after the cached system blocks, so the cached prefix is unchanged.
+CONCISE_BLOCK = {"type": "text", "text": "CONCISE MODE: Use at most 2 sentences per Strengths/Improvements bullet. No preambles, no closing remarks."}
+# The heading is "**💡 TOP 3 ...**"; the bare form catches it when the model drops the bold
+CONCISE_STOPS = ["\n**💡 TOP 3", "💡 TOP 3"]
+
+def build_message_params(user_message, model_id, max_tokens=MAX_OUTPUT_TOKENS, concise=False):
+    """Request parameters shared by the live and batch grading paths."""
+    params = {
+        "model": model_id,
+        "max_tokens": max_tokens,
+        "temperature": 0.0,
+        "system": SYSTEM_BLOCKS,
+        "messages": [{"role": "user", "content": user_message}]
+    }
+    if concise:
+        params["system"] = SYSTEM_BLOCKS + [CONCISE_BLOCK]
+        params["stop_sequences"] = CONCISE_STOPS
+    return params
+
+def finalize_feedback(raw_text, stopped=False):
+    # 0. A concise-mode stop can leave the heading's opening "**" dangling at the end
+    if stopped:
+        raw_text = raw_text.rstrip().rstrip('*').rstrip()
+    
+    # 1. Clean the Hidden Math (so user doesn't see it)
+    clean_text = clean_hidden_math(raw_text)
+    
+    # 2. Recalculate Total (Just in case)
+    return recalculate_total_score(clean_text)
+
+# Retry waits double from RETRY_BASE_DELAY up to RETRY_MAX_DELAY seconds
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+
+def backoff_delay(attempt):
+    """Exponential backoff with jitter, so parallel workers that failed together don't retry together."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+def get_retry_delay(error, attempt):
+    """Honor the server's Retry-After hint when present (plus a little jitter), otherwise back off."""
+    try:
+        retry_after = float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError): # no response, no header, or not a number of seconds
+        return backoff_delay(attempt)
+    if not 0 <= retry_after <= RETRY_MAX_DELAY: # also rejects nan
+        retry_after = RETRY_MAX_DELAY
+    return retry_after + random.uniform(0, 1)
+
+# An overload or rate limit that arrives as an SSE error event after the stream has
+# started is raised as a plain APIStatusError with the 200 of the original response
+RETRYABLE_ERROR_TYPES = {"overloaded_error", "rate_limit_error", "api_error"}
+
+def is_retryable(error):
+    """Overload (529), rate limits (429), server errors (5xx) and their mid-stream equivalents are worth waiting out."""
+    if isinstance(error, (anthropic.RateLimitError, anthropic.InternalServerError)) or error.status_code == 529:
+        return True
+    body = error.body if isinstance(error.body, dict) else {}
+    error_info = body.get("error")
+    return isinstance(error_info, dict) and error_info.get("type") in RETRYABLE_ERROR_TYPES
+
+def log_usage(model_id, message):
+    """Logs token usage for one response, so prompt-cache hits show up in the server log."""
+    usage = message.usage
+    log.info(
+        "usage [%s]: in=%d cache_read=%d cache_write=%d out=%d stop=%s",
+        model_id, usage.input_tokens, usage.cache_read_input_tokens or 0,
+        usage.cache_creation_input_tokens or 0, usage.output_tokens, message.stop_reason
+    )
+
+# Live preview refresh: at most ~20 redraws a second, or sooner once this much text is waiting
+PREVIEW_INTERVAL = 0.05
+PREVIEW_CHARS = 256
 
+def request_feedback(user_message, model_id, on_text=None, **output_options):
+    """
+    Sends one grading request (with retries) and returns the cleaned feedback. The response
+    is streamed; if on_text is given it receives the running text as it grows, throttled
+    to PREVIEW_INTERVAL (only call Streamlit from it on the script thread).
+    """
     max_retries = 5 
-    retry_delay = 5 
     
     for attempt in range(max_retries):
         try:
-            response = client.messages.create(
-                model=model_id,
-                max_tokens=3500,
-                temperature=0.0,
-                system=SYSTEM_PROMPT,
-                messages=[{"role": "user", "content": user_message}]
-            )
-            raw_text = response.content[0].text
-            
-            # 1. Clean the Hidden Math (so user doesn't see it)
-            clean_text = clean_hidden_math(raw_text)
-            
-            # 2. Recalculate Total (Just in case)
-            final_text = recalculate_total_score(clean_text)
-            
-            return final_text
+            chunks = []
+            unshown = 0
+            last_flush = time.monotonic()
+            # Only the request itself holds the gate; backoff sleeps below don't.
+            # SDK retries are off here since this loop does its own (and can also retry mid-stream errors).
+            with api_gate, client.with_options(max_retries=0).messages.stream(**build_message_params(user_message, model_id, **output_options)) as stream:
+                for text in stream.text_stream:
+                    chunks.append(text)
+                    if not on_text:
+                        continue
+                    unshown += len(text)
+                    now = time.monotonic()
+                    if now - last_flush > PREVIEW_INTERVAL or unshown > PREVIEW_CHARS:
+                        on_text("".join(chunks))
+                        unshown, last_flush = 0, now
+                if on_text and unshown:
+                    on_text("".join(chunks))
+                message = stream.get_final_message()
+                log_usage(model_id, message)
+            return finalize_feedback("".join(chunks), message.stop_reason == "stop_sequence")
             
         except (anthropic.RateLimitError, anthropic.APIStatusError) as e:
-            if isinstance(e, anthropic.APIStatusError) and e.status_code == 529:
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            if isinstance(e, anthropic.RateLimitError):
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            return f"⚠️ Error: {str(e)}"
+            if not is_retryable(e):
+                return f"⚠️ Error: {str(e)}"
+            delay = get_retry_delay(e, attempt)
+        except anthropic.APIConnectionError:
+            # SDK retries are off for the stream, so network blips are retried here
+            delay = backoff_delay(attempt)
         except Exception as e:
             return f"⚠️ Error: {str(e)}"
+        if attempt < max_retries - 1: # no point sleeping after the last attempt
+            time.sleep(delay)
+    return f"⚠️ Error: API still unavailable after {max_retries} attempts."
+
+# Fast mode grades with Haiku first; reports that land this close to the
+# borderline score (or have no parsable score) are re-graded with the main model
+FAST_MODEL_ID = "claude-haiku-4-5"
+BORDERLINE_MARGIN = 1.5
+
+def needs_second_opinion(feedback, borderline_score):
+    try:
+        return abs(float(parse_score(feedback)) - borderline_score) <= BORDERLINE_MARGIN
+    except ValueError: # "N/A" - the fast grade could not be read
+        return True
+
+def grade_submission(file, model_id, on_text=None, fast_mode=False, borderline_score=None, **output_options):
+    """output_options (max_tokens, concise) are passed through to build_message_params."""
+    user_message = build_user_message(file)
+    if not user_message: return "Error processing file."
+
+    if fast_mode:
+        feedback = request_feedback(user_message, FAST_MODEL_ID, on_text, **output_options)
+        if borderline_score is None or not needs_second_opinion(feedback, borderline_score):
+            return feedback
+    return request_feedback(user_message, model_id, on_text, **output_options)
+
+def submit_grading_batch(files, model_id, **output_options):
+    """
+    Submits one Message Batches job for the given reports without waiting for it.
+    Returns (batch_id, id_to_name, failed) - batch_id is None if nothing could be sent,
+    failed maps filenames that couldn't be prepared to their error feedback.
+    """
+    failed = {}
+    requests = []
+    id_to_name = {}
+    with ThreadPoolExecutor(max_workers=PREP_WORKERS) as executor:
+        user_messages = list(executor.map(build_user_message, files))
+    for i, (file, user_message) in enumerate(zip(files, user_messages)):
+        if not user_message:
+            failed[file.name] = "Error processing file."
+            continue
+        custom_id = f"file-{i}"
+        id_to_name[custom_id] = file.name
+        requests.append({"custom_id": custom_id, "params": build_message_params(user_message, model_id, **output_options)})
+
+    if not requests:
+        return None, id_to_name, failed
+    batch = client.messages.batches.create(requests=requests)
+    return batch.id, id_to_name, failed
+
+def collect_batch_results(batch_id, id_to_name):
+    """{filename: feedback} for a batch that has ended."""
+    feedback_by_name = {}
+    for entry in client.messages.batches.results(batch_id):
+        file_name = id_to_name.get(entry.custom_id)
+        if file_name is None:
+            continue
+        if entry.result.type == "succeeded":
+            message = entry.result.message
+            feedback_by_name[file_name] = finalize_feedback(message.content[0].text, message.stop_reason == "stop_sequence")
+        else:
+            feedback_by_name[file_name] = f"⚠️ Error: Batch request {entry.result.type}."
+    return feedback_by_name
+
+def wait_for_batch(batch_id, total, on_progress=None, max_wait=BATCH_MAX_WAIT):
+    """
+    Polls a submitted batch until it has ended. on_progress(done, total) is called after every poll.
+    Returns False if it is still running after max_wait seconds.
+    """
+    deadline = time.monotonic() + max_wait
+    batch = client.messages.batches.retrieve(batch_id)
+    while batch.processing_status != "ended":
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.messages.batches.retrieve(batch_id)
+        if on_progress:
+            on_progress(total - batch.request_counts.processing, total)
+    return True
 
 def parse_score(text):
     try:
-        # Robust Match: Handles 📝, 🔍, or no emoji at all
-        match = re.search(r"(?:#\s*[🔍📝]?\s*)?SCORE:\s*([\d\.]+)/100", text, re.IGNORECASE)
+        # Robust Match: Handles 📝, 🔍, or no emoji at all.
+        # The header is normally the first line, so try that before scanning everything.
+        first_line_end = text.find('\n')
+        match = _SCORE_RE.search(text, 0, first_line_end) if first_line_end > 0 else None
+        if not match:
+            match = _SCORE_RE.search(text)
         if match: 
             return match.group(1).strip()
-    except Exception as e:
-        print(f"Error parsing score: {e}")
+    except Exception:
+        log.exception("Error parsing score")
     return "N/A"
 
 # --- WORD FORMATTER (Strict Symbol Cleaning) ---
+_STAR_STRIP = str.maketrans('', '', '*')
+
+def add_styled_paragraph(doc, style_id, text=None):
+    """doc.add_paragraph with a pre-resolved style id. python-docx re-resolves a style name
+    by scanning styles.xml on every call, which was most of the export time."""
+    p = doc.add_paragraph(text)
+    p._p.get_or_add_pPr().style = style_id
+    return p
+
 def write_markdown_to_docx(doc, text):
+    # Resolve the three styles once per document instead of once per paragraph
+    heading_2 = doc.styles['Heading 2'].style_id
+    heading_3 = doc.styles['Heading 3'].style_id
+    bullet = doc.styles['List Bullet'].style_id
+    
     lines = text.split('\n')
     for line in lines:
         line = line.strip()
@@ -726,108 +1204,298 @@ def write_markdown_to_docx(doc, text):
             continue # SKIP EMPTY LINES FOR CONTINUOUS FLOW
         
         # 1. Handle Score Header & Student Name (Larger - Level 2)
-        if line.startswith('# ') or line.startswith('STUDENT:'): 
-            clean = line.replace('# ', '').replace('*', '').strip()
+        if line.startswith(('# ', 'STUDENT:')): 
+            clean = line.replace('# ', '').translate(_STAR_STRIP).strip()
             # Changed from Level 4 (Small) to Level 2 (Large)
-            doc.add_heading(clean, level=2) 
+            add_styled_paragraph(doc, heading_2, clean) 
             continue
         
         # 2. Handle H3 (### ) - CLEANED
         if line.startswith('### '):
-            clean = line.replace('### ', '').replace('*', '').strip()
-            doc.add_heading(clean, level=3)
+            clean = line.replace('### ', '').translate(_STAR_STRIP).strip()
+            add_styled_paragraph(doc, heading_3, clean)
             continue
         
         # 3. Handle H2 (## ) - CLEANED
         if line.startswith('## '): 
-            clean = line.replace('## ', '').replace('*', '').strip()
-            doc.add_heading(clean, level=2)
+            clean = line.replace('## ', '').translate(_STAR_STRIP).strip()
+            add_styled_paragraph(doc, heading_2, clean)
             continue
         
         # 4. REMOVE SEPARATORS
-        if line.startswith('---') or line.startswith('___'):
+        if line.startswith(('---', '___')):
             continue
 
         # 5. Handle Bullets (* or -) - CLEANED
-        if line.startswith('* ') or line.startswith('- '):
-            p = doc.add_paragraph(style='List Bullet')
+        if line.startswith(('* ', '- ')):
+            p = add_styled_paragraph(doc, bullet)
             content = line[2:] 
         else:
             p = doc.add_paragraph()
             content = line
 
         # 6. Handle Bold (**text**) - CLEANED
-        parts = re.split(r'(\*\*.*?\*\*)', content)
-        for part in parts:
-            if part.startswith('**') and part.endswith('**'):
-                clean_text = part[2:-2].replace('*', '') # Strip any lingering asterisks
-                run = p.add_run(clean_text)
+        for text, is_bold in split_bold(content):
+            run = p.add_run(text.translate(_STAR_STRIP)) # Strip lingering asterisks
+            if is_bold:
                 run.bold = True
-            else:
-                p.add_run(part.replace('*', '')) # Strip lingering asterisks
+
+def split_bold(content):
+    """Yields (text, is_bold) runs for **bold** markup in a single line."""
+    pos = 0
+    while True:
+        start = content.find('**', pos)
+        end = content.find('**', start + 2) if start != -1 else -1
+        if end == -1:
+            if pos < len(content):
+                yield content[pos:], False
+            return
+        if start > pos:
+            yield content[pos:start], False
+        yield content[start + 2:end], True
+        pos = end + 2
+
+# Each report is rendered once and cached; the bundles below are deferred downloads,
+# assembled from those cached documents only when their button is clicked
+@st.cache_data(show_spinner=False, max_entries=1000)
+def render_feedback_doc(feedback):
+    """One report's feedback as .docx bytes, rendered once and shared by every export."""
+    from docx import Document
+    doc = Document()
+    # REMOVED FEEDBACK HEADER
+    write_markdown_to_docx(doc, feedback)
+    doc_buffer = BytesIO()
+    doc.save(doc_buffer)
+    return doc_buffer.getvalue()
 
 def create_master_doc(results, session_name):
+    from docx import Document
     doc = Document()
+    body = doc.element.body
     # REMOVED SESSION HEADER
     # doc.add_heading(f"Lab Report Grades: {session_name}", 0) 
     for item in results:
         # REMOVED FILENAME HEADER (Starts with Score + Student Name)
-        write_markdown_to_docx(doc, item['Feedback'])
+        # Copy the rendered student doc's paragraphs in (same default template, so the
+        # styles match) instead of running the markdown conversion a second time
+        student_body = Document(BytesIO(render_feedback_doc(item['Feedback']))).element.body
+        for element in list(student_body):
+            if element.tag != W_SECTPR:
+                body.sectPr.addprevious(element)
         doc.add_page_break()
     bio = BytesIO()
     doc.save(bio)
     return bio.getvalue()
 
+# Every member is a .docx, which is already a deflated zip; compressing it again costs
+# CPU and saves only a few percent, so the bundles store members as-is
 def create_zip_bundle(results):
     zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as z:
         for item in results:
-            doc = Document()
-            # REMOVED FEEDBACK HEADER
-            write_markdown_to_docx(doc, item['Feedback'])
-            doc_buffer = BytesIO()
-            doc.save(doc_buffer)
             safe_name = os.path.splitext(item['Filename'])[0] + "_Feedback.docx"
-            z.writestr(safe_name, doc_buffer.getvalue())
+            z.writestr(safe_name, render_feedback_doc(item['Feedback']))
     return zip_buffer.getvalue()
 
 # --- NEW: AUTOSAVE INDIVIDUAL REPORT ---
-def autosave_report(item, autosave_dir):
-    """Save individual report as Word doc and append to CSV immediately after grading."""
+# One writer thread shared by every browser session: disk writes overlap the next
+# grade instead of delaying it, and gradebook appends from different sessions are
+# serialized without a lock
+@st.cache_resource
+def get_autosave_writer():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="autosave")
+
+@st.cache_resource
+def get_gradebook_index():
+    """
+    {csv path: (header, filenames in the file, file size)} for the gradebooks this server
+    has written. Only touched from the writer thread.
+    """
+    return {}
+
+def scan_gradebook(csv_path):
+    """Header and Filename column of an existing gradebook (empty if there is none)."""
+    if not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0:
+        return [], set()
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        filenames = {row.get('Filename') for row in reader}
+        return list(reader.fieldnames or []), filenames
+
+def write_gradebook_row(csv_path, row_data):
+    """
+    Adds one report's row to the gradebook. A new file with the usual columns is a plain
+    append; a re-graded file (its old row is replaced) or a row with new columns (the
+    header is extended) rewrites the CSV.
+    """
+    index = get_gradebook_index()
+    size = os.path.getsize(csv_path) if os.path.exists(csv_path) else -1
+    if csv_path in index and index[csv_path][2] == size:
+        fieldnames, filenames, _ = index[csv_path]
+    else:
+        # First write this process makes here, or the file was changed outside the app
+        fieldnames, filenames = scan_gradebook(csv_path)
+    new_fieldnames = (fieldnames or COLUMN_ORDER) + [
+        key for key in row_data if key not in (fieldnames or COLUMN_ORDER)
+    ]
+    
+    if fieldnames and new_fieldnames == fieldnames and row_data['Filename'] not in filenames:
+        with open(csv_path, 'a', newline='', encoding='utf-8-sig') as f:
+            csv.DictWriter(f, fieldnames, restval='').writerow(row_data)
+    else:
+        rows = []
+        if fieldnames:
+            with open(csv_path, newline='', encoding='utf-8-sig') as f:
+                # Remove duplicate if re-grading same file
+                rows = [row for row in csv.DictReader(f) if row.get('Filename') != row_data['Filename']]
+        rows.append(row_data)
+        temp_path = csv_path + ".tmp"
+        with open(temp_path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, new_fieldnames, restval='')
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(temp_path, csv_path)
+        fieldnames = new_fieldnames
+    
+    filenames.add(row_data['Filename'])
+    index[csv_path] = (fieldnames, filenames, os.path.getsize(csv_path))
+
+def write_autosave(autosave_dir, filename, doc_bytes, row_data):
+    """Disk half of autosave_report. Runs on the writer thread, so no Streamlit calls in here."""
     try:
-        # 1. Save Word Document
-        doc = Document()
-        write_markdown_to_docx(doc, item['Feedback'])
-        safe_filename = os.path.splitext(item['Filename'])[0] + "_Feedback.docx"
+        os.makedirs(autosave_dir, exist_ok=True)
+        # 1. Save Word Document (same bytes the ZIP bundle uses)
+        safe_filename = os.path.splitext(filename)[0] + "_Feedback.docx"
         doc_path = os.path.join(autosave_dir, safe_filename)
-        doc.save(doc_path)
+        with open(doc_path, 'wb') as f:
+            f.write(doc_bytes)
         
         # 2. Append to CSV (or create if doesn't exist)
         csv_path = os.path.join(autosave_dir, "gradebook.csv")
+        write_gradebook_row(csv_path, row_data)
         
+        return True
+    except Exception:
+        log.exception("Autosave failed for %s", filename)
+        return False
+
+def autosave_report(item, autosave_dir):
+    """
+    Save individual report as Word doc and append to CSV immediately after grading.
+    The document and row are built here; the writes are queued on the writer thread.
+    Returns a Future that resolves to True once both are on disk.
+    """
+    try:
         # Parse feedback into row data
         row_data = {
             "Filename": item['Filename'],
             "Overall Score": item['Score']
         }
-        feedback_data = parse_feedback_for_csv(item['Feedback'])
-        row_data.update(feedback_data)
-        
-        # Check if CSV exists
-        if os.path.exists(csv_path):
-            existing_df = pd.read_csv(csv_path)
-            # Remove duplicate if re-grading same file
-            existing_df = existing_df[existing_df['Filename'] != item['Filename']]
-            new_df = pd.concat([existing_df, pd.DataFrame([row_data])], ignore_index=True)
-        else:
-            new_df = pd.DataFrame([row_data])
-        
-        new_df.to_csv(csv_path, index=False, encoding='utf-8-sig')
-        
-        return True
-    except Exception as e:
-        print(f"Autosave failed for {item['Filename']}: {e}")
-        return False
+        row_data.update(parse_feedback_for_csv(item['Feedback']))
+        doc_bytes = render_feedback_doc(item['Feedback'])
+    except Exception:
+        log.exception("Autosave failed for %s", item['Filename'])
+        failed = Future()
+        failed.set_result(False)
+        return failed
+    return get_autosave_writer().submit(write_autosave, autosave_dir, item['Filename'], doc_bytes, row_data)
+
+GRADING_ERRORS = ("⚠️ Error", "Error processing file.")
+
+# Changes whenever the prompt, rubric or instructions are edited, so cached grades
+# from an older rubric are never reused
+PROMPT_FINGERPRINT = hashlib.blake2b(
+    "\0".join([block["text"] for block in SYSTEM_BLOCKS] + [USER_INSTRUCTIONS, CONCISE_BLOCK["text"]]).encode('utf-8'),
+    digest_size=8
+).hexdigest()
+
+def content_digest(file):
+    """
+    Hash of what actually gets graded. For a .docx that is word/document.xml and the media,
+    taken from the zip directory (name, CRC, size) without inflating anything, so a copy
+    that was re-zipped or only had its metadata (author, save time) changed still matches.
+    """
+    file_bytes = file.getvalue()
+    if file.name.lower().endswith('.docx'):
+        try:
+            with zipfile.ZipFile(BytesIO(file_bytes)) as z:
+                parts = sorted(
+                    f"{info.filename}:{info.CRC:08x}:{info.file_size}" for info in z.infolist()
+                    if info.filename == 'word/document.xml' or info.filename.startswith('word/media/')
+                )
+            if parts:
+                return hashlib.blake2b("\n".join(parts).encode('utf-8'), digest_size=16).hexdigest()
+        except zipfile.BadZipFile:
+            pass # graded (and reported) as unreadable; fall back to the raw bytes
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+def effective_grade_settings(model_id, fast_mode, borderline_score, max_tokens, concise, batch=False):
+    """
+    The grading path a report actually goes through, for its cache key: the model that grades it,
+    the model and score used for the borderline re-grade (None if there is none), then the output
+    options. Batches never re-grade, so in fast mode they are plain fast-model grades.
+    """
+    if not fast_mode:
+        return (model_id, None, None, max_tokens, concise)
+    if batch or borderline_score is None:
+        return (FAST_MODEL_ID, None, None, max_tokens, concise)
+    return (FAST_MODEL_ID, model_id, borderline_score, max_tokens, concise)
+
+def grade_cache_key(file, settings):
+    """Cache key for a report: a hash of its content, the prompt version and the settings it is graded with."""
+    return f"{content_digest(file)}|{PROMPT_FINGERPRINT}|{settings}"
+
+def save_result(file_name, feedback, cache_key=None):
+    """Adds one graded report to the current session and autosaves it. Returns (score, autosave future)."""
+    if cache_key and not feedback.startswith(GRADING_ERRORS) and st.session_state.grade_cache.get(cache_key) != feedback:
+        st.session_state.grade_cache[cache_key] = feedback
+        persist_grade_cache(st.session_state.autosave_dir, cache_key, feedback)
+    score = parse_score(feedback)
+    new_entry = {
+        "Filename": file_name,
+        "Score": score,
+        "Feedback": feedback
+    }
+    st.session_state.current_results.append(new_entry)
+    return score, autosave_report(new_entry, st.session_state.autosave_dir)
+
+# Gradebook columns in rubric order (the section headers of the feedback format)
+SECTION_NAMES = ["Formatting", "Introduction", "Hypothesis", "Variables", "Procedures",
+                 "Raw Data", "Data Analysis", "Conclusion", "Evaluation", "References"]
+COLUMN_ORDER = ['Filename', 'Overall Score', 'Overall Summary'] + [
+    f"{section} {kind}" for section in SECTION_NAMES for kind in ("Score", "Feedback")
+]
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_gradebook(results):
+    """Gradebook DataFrame (one row per report, every section score/comment) and its CSV bytes."""
+    import pandas as pd
+    rows = [
+        {"Filename": item['Filename'], "Overall Score": item['Score'], **parse_feedback_for_csv(item['Feedback'])}
+        for item in results
+    ]
+    # A section the model named differently still gets its own column, after the rubric ones
+    extra = sorted({col for row in rows for col in row}.difference(COLUMN_ORDER),
+                   key=lambda x: (x.split(' ')[0], 'Feedback' in x))
+    csv_df = pd.DataFrame.from_records(rows, columns=COLUMN_ORDER + extra)
+    
+    # Encode straight into a byte buffer rather than building the whole CSV as a str first
+    csv_buffer = BytesIO()
+    csv_df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
+    return csv_df, csv_buffer.getvalue()
+
+def read_autosave_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+# Only built when its download button is clicked (deferred data), so nothing is
+# zipped or kept in memory on reruns. Streamlit takes the BytesIO without a copy.
+def build_autosave_zip(autosave_path, filenames):
+    zip_autosave = BytesIO()
+    with zipfile.ZipFile(zip_autosave, 'w', zipfile.ZIP_STORED) as z:
+        for filename in filenames:
+            z.write(os.path.join(autosave_path, filename), filename)
+    return zip_autosave
 
 def display_results_ui():
     if not st.session_state.current_results:
@@ -836,33 +1504,14 @@ def display_results_ui():
     st.divider()
     st.subheader(f"📊 Results: {st.session_state.current_session_name}")
     
-    # --- EXPANDED CSV LOGIC WITH SORTING ---
-    results_list = []
-    for item in st.session_state.current_results:
-        row_data = {
-            "Filename": item['Filename'],
-            "Overall Score": item['Score']
-        }
-        feedback_data = parse_feedback_for_csv(item['Feedback'])
-        row_data.update(feedback_data)
-        results_list.append(row_data)
-        
-    csv_df = pd.DataFrame(results_list)
-    
-    # Sort columns to put Filename/Score/Summary first
-    cols = list(csv_df.columns)
-    priority = ['Filename', 'Overall Score', 'Overall Summary']
-    remaining = [c for c in cols if c not in priority]
-    # Simple logic to keep section score/feedback adjacent
-    remaining.sort(key=lambda x: (x.split(' ')[0], 'Feedback' in x)) 
+    csv_df, csv_data = build_gradebook(st.session_state.current_results)
     
-    final_cols = [c for c in priority if c in cols] + remaining
-    csv_df = csv_df[final_cols]
-    
-    csv_data = csv_df.to_csv(index=False).encode('utf-8-sig') 
-    
-    master_doc_data = create_master_doc(st.session_state.current_results, st.session_state.current_session_name)
-    zip_data = create_zip_bundle(st.session_state.current_results)
+    # The Word exports are deferred: Streamlit calls these when the button is clicked, so
+    # neither bundle is built or held in memory on reruns. The snapshot keeps the export
+    # matching what is on screen.
+    results = list(st.session_state.current_results)
+    master_doc_data = functools.partial(create_master_doc, results, st.session_state.current_session_name)
+    zip_data = functools.partial(create_zip_bundle, results)
     
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -880,29 +1529,31 @@ def display_results_ui():
     
     autosave_path = st.session_state.autosave_dir
     if os.path.exists(autosave_path):
-        csv_autosave = os.path.join(autosave_path, "gradebook.csv")
-        if os.path.exists(csv_autosave):
-            with open(csv_autosave, 'rb') as f:
-                st.download_button(
-                    "📥 Download Auto-saved Gradebook (CSV)",
-                    f.read(),
-                    "autosaved_gradebook.csv",
-                    "text/csv",
-                    use_container_width=True
-                )
+        # One scandir pass finds the gradebook and every doc. Both downloads below are
+        # deferred, so the files are only read (and zipped) when a button is clicked.
+        has_gradebook = False
+        docx_names = []
+        with os.scandir(autosave_path) as entries:
+            for entry in entries:
+                if entry.name == "gradebook.csv":
+                    has_gradebook = True
+                elif entry.name.endswith('.docx'):
+                    docx_names.append(entry.name)
         
-        # Create zip of all autosaved Word docs
-        autosave_files = [f for f in os.listdir(autosave_path) if f.endswith('.docx')]
-        if autosave_files:
-            zip_autosave = BytesIO()
-            with zipfile.ZipFile(zip_autosave, 'w', zipfile.ZIP_DEFLATED) as z:
-                for filename in autosave_files:
-                    file_path = os.path.join(autosave_path, filename)
-                    z.write(file_path, filename)
-            
+        if has_gradebook:
+            st.download_button(
+                "📥 Download Auto-saved Gradebook (CSV)",
+                functools.partial(read_autosave_file, os.path.join(autosave_path, "gradebook.csv")),
+                "autosaved_gradebook.csv",
+                "text/csv",
+                use_container_width=True
+            )
+        
+        # Zip of all autosaved Word docs, built on click
+        if docx_names:
             st.download_button(
                 "📥 Download All Auto-saved Word Docs (.zip)",
-                zip_autosave.getvalue(),
+                functools.partial(build_autosave_zip, autosave_path, sorted(docx_names)),
                 "autosaved_feedback.zip",
                 "application/zip",
                 use_container_width=True
@@ -915,10 +1566,13 @@ def display_results_ui():
     # 2. Show the Feedback (Stacked directly below, no hiding!)
     st.write("### 📝 Detailed Feedback History")
     
-    # We use reversed() so the newest file is always at the top
+    # We use reversed() so the newest file is always at the top.
+    # Feedback is only sent for expanders that are open (opening one reruns the page),
+    # so a long history doesn't push every report to the browser on each click.
     for item in reversed(st.session_state.current_results):
-        with st.expander(f"📄 {item['Filename']} (Score: {item['Score']})"):
-            st.markdown(item['Feedback'])
+        history = st.expander(f"📄 {item['Filename']} (Score: {item['Score']})", key=f"history_{item['Filename']}", on_change="rerun")
+        if history.open:
+            history.markdown(item['Feedback'])
 
 # --- 6. SIDEBAR ---
 with st.sidebar:
@@ -931,6 +1585,47 @@ with st.sidebar:
         help="Change this if you have a specific Beta model or newer ID"
     )
     
+    fast_mode = st.checkbox(
+        "⚡ Fast Mode (Haiku)",
+        help="Grade with Claude Haiku: several times faster and cheaper, slightly less nuanced."
+    )
+    borderline_score = None
+    if fast_mode and st.checkbox("🎯 Re-grade borderline reports with the Model ID above", value=True):
+        borderline_score = st.number_input(
+            "Borderline score",
+            min_value=0,
+            max_value=100,
+            value=70,
+            help=f"Reports whose fast score is within ±{BORDERLINE_MARGIN} of this (or unreadable) are graded again."
+        )
+    
+    max_tokens = st.slider(
+        "📏 Max Output Tokens",
+        min_value=1000,
+        max_value=4000,
+        value=MAX_OUTPUT_TOKENS,
+        step=100,
+        help="Upper limit on the length of each report's feedback. Lower is faster; too low cuts feedback short."
+    )
+    concise = st.checkbox(
+        "✂️ Concise Feedback",
+        help="Shorter bullets and no 'Top 3 steps' block: noticeably faster and cheaper."
+    )
+    output_options = {"max_tokens": max_tokens, "concise": concise}
+    
+    batch_mode = st.checkbox(
+        "📦 Batch Mode (50% cheaper, <24h)",
+        help="Submit the whole upload as one batch job and come back later. Use 'Poll Batch' to collect the grades."
+    )
+    
+    max_workers = st.slider(
+        "⚡ Parallel Requests",
+        min_value=1,
+        max_value=10,
+        value=5,
+        help="How many reports are graded at the same time. Lower this if you hit rate limits."
+    )
+    
     st.divider()
     st.header("💾 History Manager")
     save_name = st.text_input("Session Name", placeholder="e.g. Period 3 - Kinetics")
@@ -986,11 +1681,15 @@ if raw_files:
         if raw_files:
             st.warning("No valid PDF, Word, or Image files found.")
 
+# Reports kept in the live feedback list while grading
+LIVE_FEEDBACK_WINDOW = 5
+
 if st.button("🚀 Grade Reports", type="primary", disabled=not processed_files):
     
     st.write("---")
     progress = st.progress(0)
     status_text = st.empty()
+    stream_preview = st.empty()
     live_results_table = st.empty()
     
     # NEW: Placeholder for cumulative feedback display (cleared and rewritten each iteration)
@@ -1004,67 +1703,248 @@ if st.button("🚀 Grade Reports", type="primary", disabled=not processed_files)
     # Create a set of already graded filenames for quick lookup
     existing_filenames = {item['Filename'] for item in st.session_state.current_results}
     
-    for i, file in enumerate(processed_files):
-        # 1. SMART RESUME CHECK: Skip if already graded
+    # 1. SMART RESUME CHECK: Skip if already graded (or duplicated within this upload).
+    # Identical content graded earlier with the same settings reuses that feedback,
+    # and a copy repeated within this upload waits for the first one's grade.
+    grade_settings = effective_grade_settings(user_model_id, fast_mode, borderline_score, max_tokens, concise)
+    cache_keys = {}
+    reused = []
+    duplicates = {} # copy's filename -> filename of the first upload with that content
+    pending_keys = {}
+    pending_files = []
+    for file in processed_files:
         if file.name in existing_filenames:
             status_text.info(f"↩ Skipping **{file.name}** (Already Graded)")
-            time.sleep(0.5) # Brief pause for visual feedback
-            progress.progress((i + 1) / len(processed_files))
             continue
-
-        # 2. GRADING LOGIC
-        status_text.markdown(f"**Grading:** `{file.name}` ({i+1}/{len(processed_files)})...")
+        existing_filenames.add(file.name)
+        cache_keys[file.name] = grade_cache_key(file, grade_settings)
+        cached = st.session_state.grade_cache.get(cache_keys[file.name])
+        if cached:
+            reused.append((file.name, cached))
+            continue
+        if cache_keys[file.name] in pending_keys:
+            duplicates[file.name] = pending_keys[cache_keys[file.name]]
+            continue
+        pending_keys[cache_keys[file.name]] = file.name
+        pending_files.append(file)
+    
+    use_batch = bool(pending_files) and (batch_mode or len(pending_files) >= BATCH_MIN_FILES)
+    batch_settings = effective_grade_settings(user_model_id, fast_mode, borderline_score, max_tokens, concise, batch=True)
+    if use_batch and batch_settings != grade_settings:
+        # Batches get a single fast-model pass with no borderline re-grade, so they are keyed
+        # as uncascaded grades and never reused later as if they had been cascaded
+        st.info("⚡ Batch grading uses the fast model only; borderline reports are not re-graded.")
+        rekey = {file.name for file in pending_files} | set(duplicates)
+        for file in processed_files:
+            if file.name in rekey:
+                rekey.discard(file.name)
+                cache_keys[file.name] = grade_cache_key(file, batch_settings)
+        batch_files, pending_files = pending_files, []
+        for file in batch_files:
+            cached = st.session_state.grade_cache.get(cache_keys[file.name])
+            if cached:
+                reused.append((file.name, cached))
+            else:
+                pending_files.append(file)
+    
+    autosaves = []
+    live_rows = [{"Filename": item["Filename"], "Score": item["Score"]} for item in st.session_state.current_results]
+    
+    def record_result(file_name, feedback):
+        # 3. IMMEDIATE SAVE TO SESSION STATE + 4. AUTOSAVE TO DISK (CRITICAL FOR RECOVERY)
+        # The write finishes in the background; it is checked once grading is done
+        score, autosave = save_result(file_name, feedback, cache_keys.get(file_name))
+        autosaves.append((file_name, autosave))
+        status_text.success(f"✅ **{file_name}** graded! (Score: {score}/100)")
+        
+        # 5. LIVE TABLE UPDATE (one row appended, not rebuilt from every result)
+        live_rows.append({"Filename": file_name, "Score": score})
+        live_results_table.dataframe(live_rows, use_container_width=True)
         
+        # 6. UPDATED: SINGLE COPY CUMULATIVE FEEDBACK DISPLAY
+        # Clear and rewrite the feedback section to avoid duplicates. Only the latest few
+        # are redrawn (the full history is shown under Results once grading finishes),
+        # so each update costs the same however many reports are done.
+        recent = st.session_state.current_results[-LIVE_FEEDBACK_WINDOW:]
+        with feedback_placeholder.container():
+            for idx, item in enumerate(recent):
+                # Start expanded for most recent, collapsed for older ones
+                is_most_recent = (idx == len(recent) - 1)
+                with st.expander(f"📄 {item['Filename']} (Score: {item['Score']}/100)", expanded=is_most_recent):
+                    st.markdown(item['Feedback'])
+    
+    for file_name, feedback in reused:
+        record_result(file_name, feedback)
+        status_text.info(f"♻️ Reused earlier grade for **{file_name}** (identical file)")
+    
+    batch_id = None
+    live_files = pending_files
+    if use_batch and pending_files:
+        # 2. BATCH GRADING: one Message Batches job. It is listed under Pending Batches
+        # before anything waits on it, so "Poll Batch" can still collect it if this run is lost.
+        status_text.markdown(f"**Submitting batch:** {len(pending_files)} reports...")
         try:
-            # Polite delay to prevent API overloading
-            time.sleep(2) 
-            
-            feedback = grade_submission(file, user_model_id) # PASSING USER MODEL ID
-            score = parse_score(feedback)
-            
-            # 3. IMMEDIATE SAVE TO SESSION STATE
-            new_entry = {
-                "Filename": file.name,
-                "Score": score,
-                "Feedback": feedback
-            }
-            
-            st.session_state.current_results.append(new_entry)
-            
-            # 4. AUTOSAVE TO DISK (NEW - CRITICAL FOR RECOVERY)
-            autosave_success = autosave_report(new_entry, st.session_state.autosave_dir)
-            if autosave_success:
-                status_text.success(f"✅ **{file.name}** graded & auto-saved! (Score: {score}/100)")
-            else:
-                status_text.warning(f"⚠️ **{file.name}** graded but autosave failed (Score: {score}/100)")
-            
-            # Update the existing set so duplicates within the same batch run are also caught
-            existing_filenames.add(file.name)
-            
-            # 5. LIVE TABLE UPDATE
-            df_live = pd.DataFrame(st.session_state.current_results)
-            live_results_table.dataframe(df_live[["Filename", "Score"]], use_container_width=True)
+            batch_model_id = FAST_MODEL_ID if fast_mode else user_model_id
+            batch_id, id_to_name, failed = submit_grading_batch(pending_files, batch_model_id, **output_options)
+        except Exception as e:
+            st.error(f"❌ Batch submission failed: {e}" + ("" if batch_mode else ". Grading the reports live instead."))
+            batch_id, id_to_name, failed = None, {}, {}
+        
+        for file_name, feedback in failed.items():
+            record_result(file_name, feedback)
+        if batch_id:
+            # Copies of a submitted report aren't sent again; they get its grade when collected
+            copies = {copy: original for copy, original in duplicates.items() if original in id_to_name.values()}
+            add_pending_batch(batch_id, {
+                "session": st.session_state.current_session_name,
+                "files": id_to_name,
+                "copies": copies,
+                "cache_keys": {name: cache_keys[name] for name in list(id_to_name.values()) + list(copies)}
+            })
+        
+        batch_feedback = {}
+        if batch_mode:
+            live_files = []
+        elif batch_id:
+            # 2a. Large upload without Batch Mode: wait here (up to BATCH_MAX_WAIT) for the class set
+            def show_batch_progress(done, total):
+                progress.progress(done / total)
+                status_text.markdown(f"**Batch grading:** {done}/{total} reports finished...")
             
-            # 6. UPDATED: SINGLE COPY CUMULATIVE FEEDBACK DISPLAY
-            # Clear and rewrite the entire feedback section to avoid duplicates
-            with feedback_placeholder.container():
-                for idx, item in enumerate(st.session_state.current_results):
-                    # Start expanded for most recent, collapsed for older ones
-                    is_most_recent = (idx == len(st.session_state.current_results) - 1)
-                    with st.expander(f"📄 {item['Filename']} (Score: {item['Score']}/100)", expanded=is_most_recent):
-                        st.markdown(item['Feedback'])
+            try:
+                if wait_for_batch(batch_id, len(id_to_name), on_progress=show_batch_progress):
+                    batch_feedback = collect_batch_results(batch_id, id_to_name)
+                    remove_pending_batch(batch_id)
+                else:
+                    st.warning(f"⏳ The batch is still running after {BATCH_MAX_WAIT // 60} minutes; grading the reports live instead.")
+            except Exception as e:
+                st.error(f"❌ Batch grading failed: {e}. Grading the reports live instead.")
+            if batch_id in st.session_state.pending_batches:
+                # Cancel what hasn't run so those reports aren't paid for twice; whatever
+                # already finished can still be collected under Pending Batches
+                try:
+                    client.messages.batches.cancel(batch_id)
+                except Exception:
+                    log.exception("Could not cancel batch %s", batch_id)
             
-        except Exception as e:
-            st.error(f"❌ Error grading {file.name}: {e}")
+            for file in pending_files:
+                if file.name not in batch_feedback:
+                    continue
+                try:
+                    record_result(file.name, batch_feedback[file.name])
+                except Exception as e:
+                    st.error(f"❌ Error grading {file.name}: {e}")
+        
+        # Without Batch Mode, anything the batch didn't grade (submission or polling failed,
+        # or it ran too long) falls through to the live paths below
+        live_files = [file for file in live_files if file.name not in batch_feedback and file.name not in failed]
+        if live_files and batch_settings != grade_settings:
+            # Graded live they get the borderline re-grade after all, so key them (and their copies) as such
+            live_keys = {}
+            for file in live_files:
+                batch_key = cache_keys[file.name]
+                cache_keys[file.name] = live_keys[batch_key] = grade_cache_key(file, grade_settings)
+            for file_name in duplicates:
+                cache_keys[file_name] = live_keys.get(cache_keys[file_name], cache_keys[file_name])
+    
+    if live_files and (len(live_files) == 1 or max_workers == 1):
+        # 2b. LIVE GRADING: one file at a time on this thread, streaming the feedback as it is written
+        for i, file in enumerate(live_files):
+            status_text.markdown(f"**Grading:** `{file.name}` ({i+1}/{len(live_files)})...")
             
-        progress.progress((i + 1) / len(processed_files))
+            try:
+                feedback = grade_submission(
+                    file, user_model_id, # PASSING USER MODEL ID
+                    on_text=lambda text: stream_preview.markdown(preview_feedback(text)),
+                    fast_mode=fast_mode,
+                    borderline_score=borderline_score,
+                    **output_options
+                )
+                stream_preview.empty()
+                record_result(file.name, feedback)
+                
+            except Exception as e:
+                st.error(f"❌ Error grading {file.name}: {e}")
+                
+            progress.progress((i + 1) / len(live_files))
+    elif live_files:
+        # 2c. GRADING LOGIC: one request per file, several in flight at once.
+        # Workers only call the API; all Streamlit updates stay on this thread.
+        status_text.markdown(f"**Grading:** {len(live_files)} reports ({max_workers} at a time)...")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    grade_submission, file, user_model_id, # PASSING USER MODEL ID
+                    fast_mode=fast_mode,
+                    borderline_score=borderline_score,
+                    **output_options
+                ): file
+                for file in live_files
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                file = futures[future]
+                try:
+                    record_result(file.name, future.result())
+                except Exception as e:
+                    st.error(f"❌ Error grading {file.name}: {e}")
+                    
+                progress.progress(done / len(live_files))
+    
+    for file_name, original in duplicates.items():
+        feedback = st.session_state.grade_cache.get(cache_keys[file_name])
+        if feedback:
+            record_result(file_name, feedback)
+        elif batch_mode and batch_id and original in id_to_name.values():
+            continue # filled in with the batch's grade by "Poll Batch"
+        else:
+            st.warning(f"⚠️ **{file_name}** was not graded: it is identical to **{original}**, which has no grade.")
+    
+    progress.empty()
+    if batch_mode and batch_id:
+        status_text.success(f"📦 Batch submitted ({len(id_to_name)} reports). Use **Poll Batch** below to collect the grades.")
+    elif batch_mode and use_batch:
+        status_text.error("❌ No batch was submitted. Try again, or untick Batch Mode to grade live.")
+    else:
+        unsaved = [file_name for file_name, autosave in autosaves if not autosave.result()]
+        if unsaved:
+            status_text.warning(f"⚠️ Grading Complete, but autosave failed for: {', '.join(unsaved)}")
+        else:
+            status_text.success("✅ Grading Complete! All reports auto-saved.")
         
+        # Show message about autosave location
+        st.info(f"💾 **Backup Location:** All feedback has been saved to `{st.session_state.autosave_dir}/` folder. You can download individual files or the full gradebook below.")
 
-    status_text.success("✅ Grading Complete! All reports auto-saved.")
-    progress.empty()
-    
-    # Show message about autosave location
-    st.info(f"💾 **Backup Location:** All feedback has been saved to `{st.session_state.autosave_dir}/` folder. You can download individual files or the full gradebook below.")
+# --- 7b. PENDING BATCHES ---
+if st.session_state.pending_batches:
+    st.write("---")
+    st.subheader("📦 Pending Batches")
+    for batch_id, info in list(st.session_state.pending_batches.items()):
+        st.caption(f"`{batch_id}` · {len(info['files'])} reports · {info['session']}")
+        if st.button("🔄 Poll Batch", key=f"poll_{batch_id}"):
+            try:
+                batch = client.messages.batches.retrieve(batch_id)
+                if batch.processing_status != "ended":
+                    total = len(info['files'])
+                    st.info(f"⏳ Still processing: {total - batch.request_counts.processing}/{total} reports finished.")
+                    continue
+                batch_feedback = collect_batch_results(batch_id, info['files'])
+            except Exception as e:
+                st.error(f"❌ Could not poll batch: {e}")
+                continue
+            
+            for copy, original in info.get('copies', {}).items():
+                if original in batch_feedback:
+                    batch_feedback[copy] = batch_feedback[original]
+            existing_filenames = {item['Filename'] for item in st.session_state.current_results}
+            autosaves = []
+            for file_name, feedback in batch_feedback.items():
+                if file_name not in existing_filenames:
+                    autosaves.append(save_result(file_name, feedback, info.get('cache_keys', {}).get(file_name))[1])
+            # Let the writes land so the autosave downloads after the rerun include them
+            for autosave in autosaves:
+                autosave.result()
+            remove_pending_batch(batch_id)
+            st.rerun()
 
 # --- 8. PERSISTENT DISPLAY ---
 if st.session_state.current_results: